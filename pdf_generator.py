@@ -1,24 +1,29 @@
 #!/usr/bin/env python3
 """
 PDF Генератор с CLI-интерфейсом
-Без зависимости от weasyprint.fonts — работает при базовой установке
+FontConfiguration используется, если доступна — иначе работает при базовой установке
 """
 
 import os
 import sys
 import json
+import math
 import csv
-import pandas as pd
+import hashlib
+import io
+import re
+import shutil
+import subprocess
 from datetime import datetime
+from decimal import Decimal
 from pathlib import Path
-from typing import Dict, List, Any
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
 import logging
-from html import escape
-from weasyprint import HTML, CSS
-import inquirer
+from concurrent.futures import ProcessPoolExecutor
+from html.parser import HTMLParser
 from rich.console import Console
 from rich.table import Table
-from rich.progress import track
+from rich.progress import Progress, track
 from rich.prompt import IntPrompt, Confirm
 
 # Настройка логирования
@@ -32,45 +37,65 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Служебные сообщения weasyprint и его зависимостей на каждый документ не нужны
+for _noisy_logger in ('weasyprint', 'weasyprint.progress', 'fontTools', 'fontTools.subset', 'PIL'):
+    logging.getLogger(_noisy_logger).setLevel(logging.WARNING)
+
 console = Console()
 
+# orjson быстрее стандартного json, но необязателен
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
 # Пути
 ROOT_DIR = Path(__file__).parent.absolute()
 DATA_DIR = ROOT_DIR / "data"
 TEMPLATES_DIR = ROOT_DIR / "templates"
 OUTPUT_DIR = ROOT_DIR / "output"
 
+# Плейсхолдер вида {{ field_name }}
+_PLACEHOLDER_RE = re.compile(r'\{\{\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*\}\}')
+# Содержимое <body> — для склейки карточек в один документ
+_BODY_RE = re.compile(r'(<body[^>]*>)(.*)(</body>)', re.IGNORECASE | re.DOTALL)
+
 
 # Создание папок
 def create_directories():
     for directory in [DATA_DIR, TEMPLATES_DIR, OUTPUT_DIR]:
-        directory.mkdir(exist_ok=True)
-        logger.info(f"Папка {'создана' if not directory.exists() else 'уже существует'}: {directory}")
+        try:
+            directory.mkdir(exist_ok=True)
+            logger.debug(f"Папка готова: {directory}")
+        except OSError as e:
+            logger.error(f"Не удалось создать папку {directory}: {e}")
 
 
 # Поиск данных
-def find_data_files() -> List[Path]:
+def _scan_files(directory: Path, suffixes: Tuple[str, ...]) -> List[Path]:
+    # Один обход os.walk (scandir внутри) вместо отдельного rglob на каждое расширение
     files = []
-    for pattern in ["*.csv", "*.json"]:
-        files.extend(DATA_DIR.rglob(pattern))
+    for root, _, names in os.walk(directory):
+        for name in names:
+            if name.lower().endswith(suffixes):
+                files.append(Path(root) / name)
     return sorted(files)
 
 
+def find_data_files() -> List[Path]:
+    return _scan_files(DATA_DIR, ('.csv', '.json'))
+
+
 def find_template_files() -> List[Path]:
-    return sorted(TEMPLATES_DIR.rglob("*.html"))
+    return _scan_files(TEMPLATES_DIR, ('.html',))
 
 
 # Чтение данных
 def load_csv(file_path: Path) -> List[Dict[str, Any]]:
     try:
-        df = pd.read_csv(file_path)
-        for col in df.columns:
-            if df[col].dtype == 'object':
-                try:
-                    df[col] = pd.to_datetime(df[col], errors='ignore')
-                except:
-                    pass
-        return df.to_dict('records')
+        with file_path.open('r', newline='', encoding='utf-8-sig') as f:
+            return list(csv.DictReader(f))
     except Exception as e:
         logger.error(f"Ошибка чтения CSV {file_path}: {e}")
         return []
@@ -78,9 +103,8 @@ def load_csv(file_path: Path) -> List[Dict[str, Any]]:
 
 def load_json(file_path: Path) -> List[Dict[str, Any]]:
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            return [data] if isinstance(data, dict) else data
+        data = _json_loads(file_path.read_bytes())
+        return [data] if isinstance(data, dict) else data
     except Exception as e:
         logger.error(f"Ошибка чтения JSON {file_path}: {e}")
         return []
@@ -96,52 +120,164 @@ def load_data(file_path: Path) -> List[Dict[str, Any]]:
         return []
 
 
+# Числа из CSV приходят строками: целые или десятичные с точкой ("1999.90" → 1999)
+_NUMBER_RE = re.compile(r'[+-]?\d+(?:\.\d+)?')
+
+
+def parse_int(value: Any, default: int = 0) -> int:
+    if value is None:
+        return default
+    if isinstance(value, (bool, int)):
+        return int(value)
+    if isinstance(value, float) and math.isfinite(value):
+        return int(value)
+    text = str(value).strip()
+    if not text:
+        return default
+    # Decimal вместо float — без потери точности на больших целых;
+    # "1,000", "1_000" и прочие неоднозначные записи не угадываем
+    if _NUMBER_RE.fullmatch(text):
+        return int(Decimal(text))
+    logger.warning(f"Некорректное число {value!r}, используется {default}")
+    return default
+
+
 # Проверка HTML
+class _TagFound(Exception):
+    pass
+
+
+class _TagProbe(HTMLParser):
+    # Останавливает разбор на первом открывающем теге — дерево не строится
+    def handle_starttag(self, tag, attrs):
+        raise _TagFound
+
+
 def validate_html(content: str) -> bool:
-    from bs4 import BeautifulSoup
-    soup = BeautifulSoup(content, "html.parser")
-    return soup.find() is not None
+    probe = _TagProbe()
+    try:
+        probe.feed(content)
+        probe.close()
+    except _TagFound:
+        return True
+    return False
 
 
 # Поиск плейсхолдеров
-def extract_placeholders(template_content: str) -> List[str]:
-    import re
-    placeholders = re.findall(r'\{\{\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*\}\}', template_content)
-    return list(set(placeholders))
+def extract_placeholders(template_content: str) -> Set[str]:
+    return set(_PLACEHOLDER_RE.findall(template_content))
+
+
+# Экранирование HTML: один проход translate, чистые строки возвращаются как есть
+_ESCAPE_TABLE = str.maketrans({
+    '&': '&amp;',
+    '<': '&lt;',
+    '>': '&gt;',
+    '"': '&quot;',
+    "'": '&#x27;',
+})
+
+
+def fast_escape(s: str) -> str:
+    if '&' in s or '<' in s or '>' in s or '"' in s or "'" in s:
+        return s.translate(_ESCAPE_TABLE)
+    return s
 
 
 # Рендер шаблона
-def render_template(template_content: str, data: Dict[str, Any]) -> str:
-    result = template_content
-    for key, value in data.items():
-        if isinstance(value, (pd.Timestamp, datetime)):
-            value = value.strftime('%d.%m.%Y %H:%M:%S')
+def compile_template(template_content: str) -> List[Tuple[str, str, str]]:
+    # Разбиваем шаблон один раз: ('lit', текст, текст) и ('var', имя поля, исходный плейсхолдер)
+    parts = []
+    last = 0
+    for match in _PLACEHOLDER_RE.finditer(template_content):
+        literal = template_content[last:match.start()]
+        parts.append(('lit', literal, literal))
+        parts.append(('var', match.group(1), match.group(0)))
+        last = match.end()
+    literal = template_content[last:]
+    parts.append(('lit', literal, literal))
+    return parts
+
+
+def format_value(value: Any) -> str:
+    return fast_escape(str(value))
+
+
+# safe — подстановки с готовым HTML, которые не экранируются; по умолчанию их нет
+_NO_SAFE: Dict[str, str] = {}
+
+
+def compile_template_to_fn(template_content: str) -> Callable[..., str]:
+    # Генерируем функцию вида:
+    # return ''.join([lit0, safe['name'] if 'name' in safe else fmt(d['name']) if 'name' in d else raw0, ...])
+    # Неизвестные плейсхолдеры остаются в тексте как есть
+    items = []
+    for kind, chunk, raw in compile_template(template_content):
+        if kind == 'lit':
+            if chunk:
+                items.append(repr(chunk))
         else:
-            value = str(value)
-        result = result.replace(f"{{{{ {key} }}}}", escape(value))
-    return result
+            items.append(
+                f"(safe[{chunk!r}] if {chunk!r} in safe"
+                f" else fmt(d[{chunk!r}]) if {chunk!r} in d else {raw!r})"
+            )
+    source = (
+        "def _render(d, safe=_NO_SAFE, fmt=format_value):\n"
+        "    return ''.join([" + ", ".join(items) + "])\n"
+    )
+    namespace = {'format_value': format_value, '_NO_SAFE': _NO_SAFE}
+    exec(source, namespace)
+    return namespace['_render']
+
+
+# Генерация PDF
+_CSS_TEXT = '''
+@page { size: A4; margin: 1.5cm; }
+body { 
+    font-family: 'DejaVu Sans', 'Arial', sans-serif; 
+    font-size: 11pt;
+}
+table { width: 100%; border-collapse: collapse; margin: 1em 0; }
+th, td { border: 1px solid #ddd; padding: 8px; text-align: left; }
+th { background-color: #f2f2f2; }
+.header { font-size: 1.5em; font-weight: bold; margin-bottom: 1em; color: #333; }
+.footer { font-size: 0.8em; color: #666; margin-top: 2em; text-align: center; }
+'''
+
+# CSS и FontConfiguration создаются один раз, при первой генерации
+_CSS_OBJ = None
+_FONT_CONFIG = None
+
+
+def _get_stylesheet():
+    global _CSS_OBJ, _FONT_CONFIG
+    if _CSS_OBJ is None:
+        from weasyprint import CSS
+        try:
+            from weasyprint.text.fonts import FontConfiguration
+            _FONT_CONFIG = FontConfiguration()
+        except ImportError:
+            # Базовая установка без weasyprint.text.fonts — работаем без неё
+            _FONT_CONFIG = None
+        _CSS_OBJ = CSS(string=_CSS_TEXT, font_config=_FONT_CONFIG)
+    return _CSS_OBJ, _FONT_CONFIG
 
 
-# Генерация PDF без FontConfiguration
 def generate_pdf(html_content: str, output_path: Path):
+    # weasyprint тянет cairo/pango — импортируем только при первой генерации
+    from weasyprint import HTML
     try:
-        css = '''
-        @page { size: A4; margin: 1.5cm; }
-        body { 
-            font-family: 'DejaVu Sans', 'Arial', sans-serif; 
-            font-size: 11pt;
-        }
-        table { width: 100%; border-collapse: collapse; margin: 1em 0; }
-        th, td { border: 1px solid #ddd; padding: 8px; text-align: left; }
-        th { background-color: #f2f2f2; }
-        .header { font-size: 1.5em; font-weight: bold; margin-bottom: 1em; color: #333; }
-        .footer { font-size: 0.8em; color: #666; margin-top: 2em; text-align: center; }
-        '''
+        stylesheet, font_config = _get_stylesheet()
+        # Пишем в память и сохраняем на диск одной операцией
+        buffer = io.BytesIO()
         HTML(string=html_content, base_url=str(TEMPLATES_DIR)).write_pdf(
-            target=str(output_path),
-            stylesheets=[CSS(string=css)]
+            target=buffer,
+            stylesheets=[stylesheet],
+            font_config=font_config
         )
-        logger.info(f"PDF сохранён: {output_path}")
+        output_path.write_bytes(buffer.getvalue())
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(f"PDF сохранён: {output_path}")
     except Exception as e:
         logger.error(f"Ошибка генерации PDF: {e}")
         raise
@@ -176,6 +312,62 @@ def display_data_preview(data_list: List[Dict], title: str = "Предпросм
         console.print(f"[dim]и ещё {len(data_list) - 10} записей...[/dim]")
 
 
+def record_output_path(record: Dict[str, Any], template_stem: str, id_field: str, timestamp: str) -> Path:
+    safe_id = str(record.get(id_field, 'unknown')).replace(' ', '_')
+    return OUTPUT_DIR / f"{template_stem}_{safe_id}_{timestamp}.pdf"
+
+
+def unique_output_path(output_path: Path, used_paths: Set[Path]) -> Path:
+    # Записи с одинаковым id получают суффикс _2, _3, ... — параллельные задачи не пишут в один файл
+    candidate = output_path
+    counter = 2
+    while candidate in used_paths:
+        candidate = output_path.with_name(f"{output_path.stem}_{counter}{output_path.suffix}")
+        counter += 1
+    used_paths.add(candidate)
+    return candidate
+
+
+# Генерация одной карточки (верхний уровень — для передачи в ProcessPoolExecutor)
+def _generate_pdf_job(args) -> Optional[Path]:
+    html_content, output_path = args
+    try:
+        generate_pdf(html_content, output_path)
+        return output_path
+    except Exception as e:
+        logger.error(f"Ошибка при записи {output_path.name}: {e}")
+        return None
+
+
+# Склейка отрендеренных карточек в один многостраничный документ
+def combine_pages(pages: List[str]) -> str:
+    # <head> и обрамление берём из первой карточки, из остальных — только <body>
+    first = _BODY_RE.search(pages[0])
+    if first is None:
+        head, tail = "<html><body>", "</body></html>"
+    else:
+        head, tail = pages[0][:first.end(1)], pages[0][first.start(3):]
+    bodies = []
+    for page in pages:
+        match = _BODY_RE.search(page)
+        bodies.append(match.group(2) if match else page)
+    page_break = '<div style="page-break-after: always"></div>'
+    return head + page_break.join(bodies) + tail
+
+
+# Строка таблицы сводного счёта
+_INVOICE_ROW = """
+            <tr>
+                <td>{i}</td>
+                <td>{name}</td>
+                <td>{category}</td>
+                <td>{price}</td>
+                <td>{quantity}</td>
+                <td>{total}</td>
+            </tr>
+            """
+
+
 # Основной интерфейс
 def main():
     console.print("[bold blue]=== PDF ГЕНЕРАТОР ===[/bold blue]")
@@ -234,8 +426,9 @@ def main():
         console.print("[red]Некорректный HTML в шаблоне.[/red]")
         return
 
+    render = compile_template_to_fn(template_content)
     placeholders = extract_placeholders(template_content)
-    console.print(f"[blue]Требуемые поля: {', '.join(placeholders) or 'не найдены'}[/blue]")
+    console.print(f"[blue]Требуемые поля: {', '.join(sorted(placeholders)) or 'не найдены'}[/blue]")
 
     # === РЕЖИМ: СВОДНЫЙ СЧЁТ ===
     if "order_invoice" in selected_template_file.name.lower():
@@ -246,39 +439,33 @@ def main():
             console.print("[red]Недостаточно данных для формирования счёта.[/red]")
             return
 
-        table_rows = ""
+        rows = []
         grand_total = 0
         for i, prod in enumerate(selected_products, 1):
-            name = escape(str(prod.get('name', 'Неизвестно')))
-            category = escape(str(prod.get('category', 'Разное')))
-            price = int(prod.get('price', 0))
+            price = parse_int(prod.get('price', 0))
             quantity = 1
             total = price * quantity
             grand_total += total
-
-            table_rows += f"""
-            <tr>
-                <td>{i}</td>
-                <td>{name}</td>
-                <td>{category}</td>
-                <td>{price}</td>
-                <td>{quantity}</td>
-                <td>{total}</td>
-            </tr>
-            """
+            rows.append(_INVOICE_ROW.format(
+                i=i,
+                name=fast_escape(str(prod.get('name', 'Неизвестно'))),
+                category=fast_escape(str(prod.get('category', 'Разное'))),
+                price=price,
+                quantity=quantity,
+                total=total
+            ))
+        table_rows = ''.join(rows)
 
         invoice_data = {
             "invoice_id": "INV-1001",
             "customer_name": "ИП Петров",
             "date": datetime.now().strftime("%d.%m.%Y"),
             "payment_method": "Безнал",
-            "table_rows": table_rows,
             "grand_total": grand_total
         }
 
-        html_content = template_content
-        for key, value in invoice_data.items():
-            html_content = html_content.replace(f"{{{{ {key} }}}}", str(value))
+        # Значения экранируются один раз; table_rows уже собран из экранированных полей
+        html_content = render(invoice_data, {"table_rows": table_rows})
 
         output_path = OUTPUT_DIR / f"order_invoice_{invoice_data['invoice_id']}_{timestamp}.pdf"
         generated_files = []  # временный список
@@ -302,16 +489,80 @@ def main():
     generated_files = []
     id_field = 'id' if 'id' in data_records[0] else next(iter(data_records[0].keys()))
 
-    if batch_mode:
-        for record in track(data_records, description="Генерация PDF..."):
+    single_file = batch_mode and Confirm.ask("Собрать все записи в один PDF?", default=False)
+
+    if single_file:
+        pages = [
+            render(record)
+            for record in track(data_records, description="Рендер шаблонов...")
+        ]
+        output_path = OUTPUT_DIR / f"{selected_template_file.stem}_all_{timestamp}.pdf"
+        try:
+            generate_pdf(combine_pages(pages), output_path)
+            generated_files.append(output_path)
+            console.print(f"[green]PDF создан: {output_path.name} ({len(pages)} записей)[/green]")
+        except Exception as e:
+            console.print(f"[red]Ошибка генерации: {e}[/red]")
+            return
+    elif batch_mode:
+        # Одинаковый HTML рендерим в PDF один раз, дубликаты копируем
+        jobs = []
+        planned = []  # (путь, источник копии или None) — в порядке записей
+        first_by_digest: Dict[bytes, Path] = {}
+        used_paths: Set[Path] = set()
+        for record in data_records:
             try:
-                html_content = render_template(template_content, record)
-                safe_id = str(record.get(id_field, 'unknown')).replace(' ', '_')
-                output_path = OUTPUT_DIR / f"{selected_template_file.stem}_{safe_id}_{timestamp}.pdf"
-                generate_pdf(html_content, output_path)
-                generated_files.append(output_path)
+                html_content = render(record)
+                output_path = unique_output_path(
+                    record_output_path(record, selected_template_file.stem, id_field, timestamp), used_paths
+                )
             except Exception as e:
                 logger.error(f"Ошибка при записи {record}: {e}")
+                continue
+            digest = hashlib.blake2b(html_content.encode('utf-8'), digest_size=16).digest()
+            source_path = first_by_digest.get(digest)
+            if source_path is None:
+                first_by_digest[digest] = output_path
+                jobs.append((html_content, output_path))
+            planned.append((output_path, source_path))
+
+        # Пул нужен только для нескольких задач: каждый процесс заново импортирует weasyprint и CSS
+        created = set()
+        max_workers = min(len(jobs), os.cpu_count() or 1)
+        if sys.platform.startswith('win'):
+            # ProcessPoolExecutor на Windows допускает не более 61 процесса
+            max_workers = min(max_workers, 61)
+        if max_workers > 1:
+            # Редкая перерисовка, чтобы консоль не тормозила сбор результатов из пула
+            with ProcessPoolExecutor(max_workers=max_workers) as executor, \
+                    Progress(console=console, refresh_per_second=4, transient=True) as progress:
+                task = progress.add_task("Генерация PDF...", total=len(jobs))
+                for output_path in executor.map(_generate_pdf_job, jobs, chunksize=4):
+                    progress.update(task, advance=1)
+                    if output_path is not None:
+                        created.add(output_path)
+        else:
+            for job in jobs:
+                output_path = _generate_pdf_job(job)
+                if output_path is not None:
+                    created.add(output_path)
+
+        duplicates = 0
+        for output_path, source_path in planned:
+            if source_path is None:
+                if output_path in created:
+                    generated_files.append(output_path)
+                continue
+            duplicates += 1
+            if source_path not in created:
+                continue
+            try:
+                shutil.copyfile(source_path, output_path)
+                generated_files.append(output_path)
+            except OSError as e:
+                logger.error(f"Ошибка при копировании {output_path.name}: {e}")
+        if duplicates:
+            logger.info(f"Повторяющихся записей: {duplicates}, PDF скопированы без рендера")
     else:
         console.print("\n[bold]Выберите запись:[/bold]")
         for i, record in enumerate(data_records):
@@ -320,9 +571,8 @@ def main():
         selected_record = data_records[record_choice - 1]
 
         try:
-            html_content = render_template(template_content, selected_record)
-            safe_id = str(selected_record.get(id_field, 'unknown')).replace(' ', '_')
-            output_path = OUTPUT_DIR / f"{selected_template_file.stem}_{safe_id}_{timestamp}.pdf"
+            html_content = render(selected_record)
+            output_path = record_output_path(selected_record, selected_template_file.stem, id_field, timestamp)
             generate_pdf(html_content, output_path)
             generated_files.append(output_path)
             console.print(f"[green]PDF создан: {output_path.name}[/green]")
@@ -339,7 +589,6 @@ def main():
 
 if __name__ == "__main__":
     try:
-        import subprocess
         main()
     except KeyboardInterrupt:
         console.print("\n[red]Прервано.[/red]")